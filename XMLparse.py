@@ -9,24 +9,43 @@
 # ---------------------------------- IMPORTS ----------------------------------
 
 import sys
+import copy
 import re
 import xml.etree.ElementTree as et
-from xml.dom import minidom
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import islice
 
-# --------------------------------- FUNCTIONS ---------------------------------
+# ---------------------------------- GLOBALS ----------------------------------
+
+# note: matching state lives in a per-pass memo dict created by each search and
+# passed down; it maps (source node, target node) pairs to the source index of
+# each target child's friend (None when the pair does not match), target nodes
+# to their attribute plans, and (node,) to the node's subtree size, and is
+# dropped when the search returns
 
-# return a list of subtrees of root
-def listify_children(root):
-	child_list = []
+# target attribute values of the form "re{...}" are interpreted as regex patterns
+_RE_PREFIX = re.compile(r"re\{.*\}")
 
-	for child in root:
-		child_list.append(child)
+# engine compiling those patterns: the standard re module unless use_re2() opts in
+_re_engine = re
 
-	return child_list
+# candidate nodes and the matcher specialized to the target, built once in each parallel_search worker process
+_worker_candidates = None
+_worker_match = None
+
+# --------------------------------- FUNCTIONS ---------------------------------
 
 # ensure target children are a subset of root children
 # matching is order-sensitive (third target child must be third-matched source child)
-def setwise_match(source_root, target_root):
+# friends: if given, receives the source index of each target child's friend
+def setwise_match(source_root, target_root, memo=None, friends=None):
+	if memo is None:
+		memo = {}
+	if friends is None:
+		friends = []
+
 	source_size = len(source_root)
 	target_size = len(target_root)
 
@@ -38,62 +57,187 @@ def setwise_match(source_root, target_root):
 	if source_size < target_size:
 		return False
 
-	# list children from each tree
-	source_children = listify_children(source_root)
-	target_children = listify_children(target_root)
-
 	# keep source nodes from being checked more than once
 	j = 0
 
+	# source children that may be skipped over in total
+	slack = source_size - target_size
+
 	# find a friend for each target child
 	for i in range(0, target_size):
 		friend_found = False
+		target_child = target_root[i]
+		target_child_size = subtree_size(target_child, memo)
 
 		# seek the first available friend
-		while j < source_size:
-			if match_structures(source_children[j], target_children[i]):
+		# leave at least one potential friend for each remaining target child
+		limit = slack + i + 1
+		while j < limit:
+			source_child = source_root[j]
+
+			# a smaller subtree cannot hold the target child
+			# note: the tag is compared first so only plausible friends are ever sized
+			if source_child.tag == target_child.tag and (target_child_size == 1 or subtree_size(source_child, memo) >= target_child_size) and match_structures(source_child, target_child, memo):
 				friend_found = True
+				friends.append(j)
 				j += 1
 				break
 			j += 1
 
 		# all target children require friends
-		# fail if too few potential friends remain
-		if not friend_found or source_size - j < target_size - (i + 1):
+		if not friend_found:
 			return False
 
 	# all target children have found friends
 	return True
 
+# return the number of nodes in root's subtree (root included)
+# unsized descendants are sized on the way (iterative post-order) and kept in memo
+def subtree_size(root, memo):
+	k = (root,)
+	if k in memo:
+		return memo[k]
+
+	stack = [(root, False)]
+	while len(stack) > 0:
+		node, children_sized = stack.pop()
+
+		if children_sized:
+			size = 1
+			for child in node:
+				size += memo[(child,)]
+			memo[(node,)] = size
+			continue
+
+		stack.append((node, True))
+		for child in node:
+			if (child,) not in memo:
+				stack.append((child, False))
+
+	return memo[k]
+
+# opt in (or back out) of compiling target attribute patterns with RE2 (google-re2)
+# note: RE2 runs in linear time with no backtracking, but reads some patterns
+# differently from re (e.g. \d and \w match ASCII only), so the same target can
+# select different nodes under each engine
+def use_re2(enabled=True):
+	global _re_engine
+
+	if enabled:
+		import re2
+		_re_engine = re2
+	else:
+		_re_engine = re
+
+	# patterns compiled by the previous engine must not be reused
+	attribute_pattern.cache_clear()
+
+# return the compiled regex for a target attribute value, or None if it is a literal
+# note: bounded so a long session of differing targets cannot grow it without limit
+@lru_cache(maxsize=256)
+def attribute_pattern(value):
+	if _RE_PREFIX.match(value):
+		body = value[3:-1]
+		try:
+			pattern = _re_engine.compile(body)
+		except _re_engine.error:
+			# RE2 lacks backreferences and lookaround, so such patterns fall back to re
+			pattern = re.compile(body)
+	else:
+		pattern = None
+
+	return pattern
+
+# split a target node's attributes into literal (key, value) and regex (key, pattern) pairs
+def attribute_plan(target_node, memo):
+	try:
+		return memo[target_node]
+	except KeyError:
+		pass
+
+	literals = []
+	patterns = []
+	for key, value in target_node.attrib.items():
+		pattern = attribute_pattern(value)
+		if pattern is None:
+			literals.append((key, value))
+		else:
+			patterns.append((key, pattern))
+
+	plan = (literals, patterns)
+	memo[target_node] = plan
+	return plan
+
 # verify whether all attributes from target_node are present and matching in source_node
 # target attribute values are interpreted as regex
-def attribute_subset_match(source_node, target_node):
+def attribute_subset_match(source_node, target_node, memo=None):
 	target_size = len(target_node.attrib)
 
 	if target_size == 0:
 		return True
 
-	if len(source_node.attrib) < target_size:
+	source_attrib = source_node.attrib
+	if len(source_attrib) < target_size:
 		return False
 
-	try:
-		for key in target_node.attrib:
-			# target attribute values surrounded in "re{...}" are interpreted as regex patterns
-			if re.match("re\{.*\}", target_node.attrib[key]):
-				attribute_matches = re.match(target_node.attrib[key][3:-1], source_node.attrib[key])
-			else:
-				attribute_matches = (target_node.attrib[key] == source_node.attrib[key])
+	if memo is None:
+		memo = {}
+	literals, patterns = attribute_plan(target_node, memo)
 
-			if not attribute_matches:
-				return False
-	except KeyError: # key does not exist in source
-		return False
+	# cheap literal comparisons go first
+	# note: a key missing from source reads as None and fails either check
+	for key, value in literals:
+		if source_attrib.get(key) != value:
+			return False
+
+	for key, pattern in patterns:
+		source_value = source_attrib.get(key)
+		if source_value is None or not pattern.match(source_value):
+			return False
 
 	return True
 
 # match root-level structure
-def match_structures(source_root, target_root):
-	return (source_root.tag == target_root.tag) and attribute_subset_match(source_root, target_root) and setwise_match(source_root, target_root)
+# memo: per-pass dict so each (source, target) pair is decided once; a direct call starts afresh
+def match_structures(source_root, target_root, memo=None):
+	# tag mismatches are the common case and cost less than a memo lookup
+	if source_root.tag != target_root.tag:
+		return False
+
+	if memo is None:
+		memo = {}
+
+	k = (source_root, target_root)
+	if k in memo:
+		return memo[k] is not None
+
+	# cheapest checks first; leaf targets need nothing past their attributes
+	target_size = len(target_root)
+	friends = []
+	if target_size > len(source_root):
+		result = False
+	elif target_root.attrib and not attribute_subset_match(source_root, target_root, memo):
+		result = False
+	else:
+		result = target_size == 0 or setwise_match(source_root, target_root, memo, friends)
+
+	# keep the friends chosen for trim_branches
+	memo[k] = friends if result else None
+	return result
+
+# count the tags in root's subtree (root included)
+# note: iter() walks the subtree without recursion
+def tag_counts(root):
+	return Counter(node.tag for node in root.iter())
+
+# rule out a source that lacks tags the target needs anywhere in it
+def tag_counts_cover(source_root, target_root):
+	for tag, count in tag_counts(target_root).items():
+		# iter(tag) filters in C, and islice stops once enough are seen
+		if len(list(islice(source_root.iter(tag), count))) < count:
+			return False
+
+	return True
 
 # return a list of all first-order children of each element in the provided list
 def one_level_in(parent_list):
@@ -105,84 +249,122 @@ def one_level_in(parent_list):
 
 # (breadth-first or depth-first) seek target structure anywhere within the source
 def exhaustive_match(source_root, target_root, mode="bfs"):
-	if match_structures(source_root, target_root):
+	memo = {}
+
+	if match_structures(source_root, target_root, memo):
 			return True
 
 	if mode == "bfs":
 		parent_list = list(source_root)
 		while len(parent_list) > 0:
 			for parent in parent_list:
-				if match_structures(parent, target_root) == True:
+				if match_structures(parent, target_root, memo) == True:
 					return True
 
 			parent_list = one_level_in(parent_list)
 
 	elif mode == "dfs":
-		for child in source_root:
-			if exhaustive_match(child, target_root, "dfs") == True:
+		# iter() walks the whole subtree in depth-first order within this pass
+		for node in source_root.iter():
+			if match_structures(node, target_root, memo):
 				return True
 
 	return False
 
+# seek target structure anywhere within an XML file (path or binary file object), reading it as a stream
+# stops at the first match; elements whose tags never appear in the target are dropped once closed
+def stream_match(source, target_root):
+	if isinstance(source, str):
+		with open(source, "rb") as source_file:
+			return stream_match(source_file, target_root)
+
+	memo = {}
+	target_tags = {node.tag for node in target_root.iter()}
+
+	# open elements, innermost last, each with the number of its closed children still kept
+	open_list = []
+
+	for event, node in et.iterparse(source, events=("start", "end")):
+		if event == "start":
+			node.tag = sys.intern(node.tag)
+			open_list.append([node, 0])
+			continue
+
+		# node and its subtree are complete
+		open_list.pop()
+		if node.tag == target_root.tag and match_structures(node, target_root, memo):
+			return True
+
+		if len(open_list) == 0:
+			continue
+
+		# siblings close in document order, so node sits just past the kept ones
+		# note: iterparse may already have appended later siblings, so node need not be last
+		parent_entry = open_list[-1]
+		if node.tag not in target_tags:
+			# such a node can never be a friend, so its parent need not keep it
+			del parent_entry[0][parent_entry[1]]
+		else:
+			parent_entry[1] += 1
+
+	return False
+
 # remove nodes from source not present in target
-def trim_branches(matched_root, target_root):
+# memo: per-pass dict from the search that found matched_root, if any
+def trim_branches(matched_root, target_root, memo=None):
+	if memo is None:
+		memo = {}
 
-	# copy the top level of matched_root only
-	trimmed_root = et.Element(matched_root.tag, matched_root.attrib)
-	trimmed_root.text = matched_root.text
-	# note: matched_root.tail is not used elsewhere, so it is ignored
+	trimmed_root = None
 
-	# (base case) target_root has no children
-	if len(target_root) == 0:
-		return trimmed_root
+	# each work item copies one matched node beneath its trimmed parent
+	work = [(matched_root, target_root, None)]
+	while len(work) > 0:
+		matched_node, target_node, trimmed_parent = work.pop()
 
-	# copy matched_root's children into a list
-	matched_children = []
-	for i in range(0, len(matched_root)):
-		matched_children.append(matched_root[i])
+		# reuse the friends chosen while matching, pairing them up again if needed
+		if not match_structures(matched_node, target_node, memo):
+			raise ValueError("matched_root does not match target_root")
+		friends = memo[(matched_node, target_node)]
 
-	# remove extra children from beginning/middle of match
-	for t_child_index in range(0, len(target_root)):
-		while not match_structures(matched_children[t_child_index], target_root[t_child_index]):
-			matched_children.pop(t_child_index)
+		# copy the top level of matched_node only
+		trimmed_node = et.Element(matched_node.tag, matched_node.attrib)
+		trimmed_node.text = matched_node.text
+		# note: matched_node.tail is not used elsewhere, so it is ignored
 
-	# remove extra children from end of match
-	diff = max(0, len(matched_children) - len(target_root))
-	for i in range(0, diff):
-		matched_children.pop()
+		if trimmed_parent is None:
+			trimmed_root = trimmed_node
+		else:
+			trimmed_parent.append(trimmed_node)
 
-	# (recursion) trim each child and add it back to the root
-	for i in range(0, len(matched_children)):
-		trimmed_root.append(trim_branches(matched_children[i], target_root[i]))
+		# queue children last-first so each parent receives them in order
+		for i in range(len(target_node) - 1, -1, -1):
+			work.append((matched_node[friends[i]], target_node[i], trimmed_node))
 
 	return trimmed_root
 
 # (breadth-first or depth-first) return the root of first-found structure matching the target
 # strict: trim match to remove untargeted elements
 def search(source_root, target_root, strict=False, mode= "dfs"):
-	if mode == "dfs":
-		if match_structures(source_root, target_root):
-			if strict is True:
-				return trim_branches(source_root, target_root)
-			else:
-				return source_root
+	memo = {}
 
-		for child in source_root:
-			r = search(child, target_root, "dfs")
-			if r:
+	if mode == "dfs":
+		# iter() visits source_root and its descendants in depth-first order
+		for node in source_root.iter():
+			if match_structures(node, target_root, memo):
 				if strict is True:
-					return(trim_branches(r, target_root))
+					return trim_branches(node, target_root, memo)
 				else:
-					return r
+					return node
 
 	elif mode == "bfs":
 		parent_list = list(source_root)
 
 		while len(parent_list) > 0:
 			for parent in parent_list:
-				if match_structures(parent, target_root):
+				if match_structures(parent, target_root, memo):
 					if strict is True:
-						return trim_branches(parent, target_root)
+						return trim_branches(parent, target_root, memo)
 					else:
 						return parent
 
@@ -190,72 +372,233 @@ def search(source_root, target_root, strict=False, mode= "dfs"):
 
 	return None
 
+# return the nodes bearing tag, in depth-first or breadth-first order
+# note: breadth-first order starts below root, as in the breadth-first searches
+def nodes_with_tag(root, tag, mode="dfs"):
+	if mode == "dfs":
+		# iter(tag) filters in C as it walks
+		return list(root.iter(tag))
+
+	nodes = []
+	if mode == "bfs":
+		parent_list = list(root)
+		while len(parent_list) > 0:
+			for parent in parent_list:
+				if parent.tag == tag:
+					nodes.append(parent)
+
+			parent_list = one_level_in(parent_list)
+
+	return nodes
+
 # (breadth-first or depth-first) return the roots of all structures matching the target
 def exhaustive_search(source_root, target_root, strict=False, mode= "dfs", match_list=None):
 	if match_list is None:
 		match_list = []
 
-	if mode == "dfs":
-		if match_structures(source_root, target_root):
-			if strict is True:
-				match_list.append(trim_branches(source_root, target_root))
-			else:
-				match_list.append(source_root)
+	# every node is visited anyway, so one tag count over the source can rule out all of them
+	if not tag_counts_cover(source_root, target_root):
+		return match_list
 
-		for child in source_root:
-			exhaustive_search(child, target_root, strict, "dfs", match_list)
+	# one fixed target is tested against every candidate, so specialize the matcher to it
+	# memo only serves trim_branches for the matches found
+	match = compile_matcher(target_root)
+	memo = {}
 
-	elif mode == "bfs":
-		parent_list = list(source_root)
+	# only nodes sharing the target's root tag can match
+	for node in nodes_with_tag(source_root, target_root.tag, mode):
+		if match(node):
+			if strict is True:
+				match_list.append(trim_branches(node, target_root, memo))
+			else:
+				match_list.append(node)
 
-		while len(parent_list) > 0:
-			for parent in parent_list:
-				if match_structures(parent, target_root):
-					if strict is True:
-						match_list.append(trim_branches(parent, target_root))
-					else:
-						match_list.append(parent)
+	return match_list
 
-			parent_list = one_level_in(parent_list)
+# flatten a tree into preorder (tag, attributes, parent row) rows that pickle without recursion
+# note: text is dropped, since matching never reads it
+def flatten_tree(root):
+	rows = []
+
+	stack = [(root, -1)]
+	while len(stack) > 0:
+		node, parent_row = stack.pop()
+		rows.append((node.tag, dict(node.attrib), parent_row))
+
+		# push children last-first so rows stay in preorder
+		row = len(rows) - 1
+		for child in reversed(node):
+			stack.append((child, row))
+
+	return rows
+
+# rebuild the root of a tree flattened by flatten_tree
+def unflatten_tree(rows):
+	nodes = []
+	for tag, attrib, parent_row in rows:
+		if parent_row < 0:
+			nodes.append(et.Element(sys.intern(tag), attrib))
+		else:
+			nodes.append(et.SubElement(nodes[parent_row], sys.intern(tag), attrib))
+	return nodes[0]
+
+# (worker process) rebuild both trees once and list the same candidates as the caller
+# re2_enabled: carry over the caller's use_re2() choice
+def load_worker_trees(source_rows, target_rows, mode, re2_enabled):
+	global _worker_candidates, _worker_match
+	use_re2(re2_enabled)
+
+	source_root = unflatten_tree(source_rows)
+	target_root = unflatten_tree(target_rows)
+
+	_worker_candidates = nodes_with_tag(source_root, target_root.tag, mode)
+	_worker_match = compile_matcher(target_root)
+
+# (worker process) report whether the candidate at index matches the target
+def match_candidate(index):
+	return _worker_match(_worker_candidates[index])
+
+# (breadth-first or depth-first) return the roots of all structures matching the target, tested across processes
+# strict: trim match to remove untargeted elements
+def parallel_search(source_root, target_root, strict=False, mode="dfs", workers=None):
+	if not tag_counts_cover(source_root, target_root):
+		return []
+
+	candidates = nodes_with_tag(source_root, target_root.tag, mode)
+	if len(candidates) == 0:
+		return []
+
+	# each worker receives the trees once; candidates travel as indices into the shared order
+	with ProcessPoolExecutor(max_workers=workers, initializer=load_worker_trees, initargs=(flatten_tree(source_root), flatten_tree(target_root), mode, _re_engine is not re)) as executor:
+		results = list(executor.map(match_candidate, range(0, len(candidates)), chunksize=64))
+
+	memo = {}
+	match_list = []
+	for node, matched in zip(candidates, results):
+		if matched:
+			if strict is True:
+				match_list.append(trim_branches(node, target_root, memo))
+			else:
+				match_list.append(node)
 
 	return match_list
 
+# emit Python source for a matcher specialized to one target tree
+# each target node becomes a function match_<n>(s) with its tag, attributes, and children baked in
+# regex attributes are bound in namespace as pattern_<n>_<m>
+def emit_matcher(target_root, namespace):
+	numbers = {node: n for n, node in enumerate(target_root.iter())}
+	lines = []
+
+	for node, n in numbers.items():
+		lines.append("def match_%d(s):" % n)
+		lines.append("\tif s.tag != %r:" % node.tag)
+		lines.append("\t\treturn False")
+
+		if len(node.attrib) > 0:
+			lines.append("\tattrib = s.attrib")
+			m = 0
+			for key, value in node.attrib.items():
+				pattern = attribute_pattern(value)
+				if pattern is None:
+					lines.append("\tif attrib.get(%r) != %r:" % (key, value))
+				else:
+					namespace["pattern_%d_%d" % (n, m)] = pattern
+					lines.append("\tvalue = attrib.get(%r)" % key)
+					lines.append("\tif value is None or not pattern_%d_%d.match(value):" % (n, m))
+					m += 1
+				lines.append("\t\treturn False")
+
+		# unrolled setwise_match: same greedy friend choice and scan bounds
+		target_size = len(node)
+		if target_size > 0:
+			lines.append("\tn = len(s)")
+			lines.append("\tif n < %d:" % target_size)
+			lines.append("\t\treturn False")
+			lines.append("\tj = 0")
+			for i, child in enumerate(node):
+				tail_size = target_size - i - 1
+				if tail_size > 0:
+					lines.append("\twhile j < n - %d:" % tail_size)
+				else:
+					lines.append("\twhile j < n:")
+				lines.append("\t\tj += 1")
+				lines.append("\t\tif match_%d(s[j - 1]):" % numbers[child])
+				lines.append("\t\t\tbreak")
+				lines.append("\telse:")
+				lines.append("\t\treturn False")
+
+		lines.append("\treturn True")
+		lines.append("")
+
+	return "\n".join(lines)
+
+# return a function testing whether a source node matches target_root, specialized to that target
+# note: the matcher has no per-pass memo, so it suits one target tested against many sources (see exhaustive_search)
+def compile_matcher(target_root):
+	namespace = {}
+	source = emit_matcher(target_root, namespace)
+	exec(compile(source, "<matcher>", "exec"), namespace)
+	return namespace["match_0"]
+
 # print the tree given with indentation
-stindent = 0
 def show_tree(root):
-	global stindent
+	lines = []
+
+	stack = [(root, 0)]
+	while len(stack) > 0:
+		node, indent = stack.pop()
+		lines.append("  " * indent + node.tag)
 
-	print("  " * stindent + root.tag)
+		# push children last-first so they print in order
+		for child in reversed(node):
+			stack.append((child, indent + 1))
 
-	stindent += 1
-	for child in root:
-		show_tree(child)
-	stindent -= 1
+	print("\n".join(lines))
+
+# share one string object per tag so tag comparisons across trees are identity checks
+def intern_tags(root):
+	for node in root.iter():
+		node.tag = sys.intern(node.tag)
+	return root
 
 # process argument and load XML from text
+# arguments beginning with "<" are inline XML, anything else is a filename
 def get_root_from_arg(arg):
-	if re.match(".*[.].*", arg):
-		return et.parse(arg).getroot()
-	return et.XML(arg)
+	if arg.lstrip().startswith("<"):
+		return intern_tags(et.XML(arg))
+	return intern_tags(et.parse(arg).getroot())
 
 # return the XML text equivalent of a tree
+# note: indentation is applied to a copy so the caller's tree keeps its whitespace
 def get_source(node):
-	return minidom.parseString(et.tostring(node, encoding="UTF-8").decode()).toprettyxml()
+	node = copy.deepcopy(node)
+	et.indent(node, space="    ")
+	return et.tostring(node, encoding="unicode")
 
 def attribs_to_string(attribs):
-	string = ""
-	for attr, val in attribs.items():
-		string += " %s=\"%s\"" % (attr, val)
-	return string
+	return "".join(" %s=\"%s\"" % (attr, val) for attr, val in attribs.items())
 
 def get_source_tags(node, level=0):
-	tag = re.search(r"\w*$", node.tag).group()
-	source = "    " * level + "<" + tag + attribs_to_string(node.attrib) + ">\n"
-	for child in node:
-		source += get_source_tags(child, level + 1) + "\n"
+	lines = []
+
+	# stack holds nodes still to open and closing-tag lines still to emit
+	stack = [(node, level)]
+	while len(stack) > 0:
+		item = stack.pop()
+		if isinstance(item, str):
+			lines.append(item)
+			continue
+
+		node, level = item
+		tag = re.search(r"\w*$", node.tag).group()
+		lines.append("    " * level + "<" + tag + attribs_to_string(node.attrib) + ">")
+
+		stack.append("    " * level + "</%s>" % tag)
+		for child in reversed(node):
+			stack.append((child, level + 1))
 
-	source += "    " * level + "</%s>" % tag
-	return source
+	return "\n".join(lines)
 
 # --------------------------------- PROCEDURE ---------------------------------
 